@@ -7,10 +7,18 @@ Requirements:
     2. pymodbus AND pymodbusTCP
 """
 """
-<plugin key="VictronEnergy_GX_MPPT" name="Victron Energy MPPT over GX + Modbus" author="Xavier Beaudouin" version="0.0.2" externallink="https://github.com/xbeaudouin/victron-energy-domoticz/mppt">
+<plugin key="VictronEnergy_GX_MPPT" name="Victron Energy MPPT over GX + Modbus" author="Xavier Beaudouin" version="0.0.3" externallink="https://github.com/xbeaudouin/victron-energy-domoticz/mppt">
     <params>
         <param field="Address" label="GX IP Address" width="150px" required="true" />
         <param field="Port" label="GX Modbus Port Number" width="100px" required="true" default="502" />
+        <param field="Mode1" label="Unit discovery" width="200px">
+            <options>
+                <option label="Use cached map" value="Cache" default="true" />
+                <option label="Rescan on start" value="Rescan" />
+                <option label="Off (use address below)" value="Off" />
+            </options>
+        </param>
+        <param field="Mode2" label="Poll interval (s)" width="50px" required="true" default="10" />
         <param field="Mode3" label="Modbus address" width="100px" required="true" default="229" />
         <param field="Mode6" label="Debug" width="100px">
             <options>
@@ -23,7 +31,10 @@ Requirements:
 """
 
 import Domoticz
+import json
+import os
 import sys
+import time
 
 sys.path.append('/usr/local/lib/python3.4/dist-packages')
 sys.path.append('/usr/local/lib/python3.5/dist-packages')
@@ -36,9 +47,46 @@ sys.path.append('/usr/local/lib/python3.10/dist-packages')
 import pymodbus
 
 from pyModbusTCP.client import ModbusClient
+from pyModbusTCP.constants import MB_TIMEOUT_ERR, EXP_DATA_ADDRESS, EXP_GATEWAY_PATH_UNAVAILABLE, EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND
 from pymodbus.constants import Endian
 from pymodbus.payload   import BinaryPayloadDecoder
 
+#
+# Unit IDs and registers differ from one GX installation to another.
+# On first heartbeat the plugin scans the plausible unit IDs, starting with the configured one, and probes the
+# register blocks it uses with bulk reads. The result (the capability map) is cached in the plugin folder, and
+# the heartbeat only queries registers known to exist.
+#
+
+# Register blocks (first register, count) used by the plugin, per role
+ROLES = {
+    "mppt": [(776, 2), (789, 2)],
+}
+
+# Unit IDs tried during discovery after the configured one: the GX itself, then the device range
+DISCOVERY_UNITS = [100] + list(range(223, 248))
+
+# Timeout (seconds) of the discovery probes, most of them are expected to fail
+DISCOVERY_TIMEOUT = 1
+
+# Time (seconds) reads may keep failing before discovery is run again
+MAX_FAILURE_TIME = 50
+
+# Delay (seconds) before the registers missing from an incomplete capability map are probed again
+REPROBE_INTERVAL = 300
+
+# Domoticz heartbeat (seconds), also the sampling period of the priority registers
+HEARTBEAT = 1
+
+# Share of the heartbeat a cycle may use before low priority registers are dropped
+BUDGET = 0.8
+
+# Maximum number of full cycles the low priority registers are skipped after an overrun
+MAX_BACKOFF = 32
+
+# Registers read on every heartbeat, and still read when the poll cycle is over budget: power
+PRIORITY_REGISTERS = [789]
+
 #
 # Domoticz shows graphs with intervals of 5 minutes.
 # When collecting information from the inverter more frequently than that, then it makes no sense to only show the last value.
@@ -97,6 +145,86 @@ class Maximum:
     def get(self):
         return max(self.samples)
 
+#
+# Domoticz heartbeats are not regular, and a slow Modbus cycle would stretch the sampling period (and the
+# window of the Average class with it).
+#
+# The Scheduler class runs the poll cycles at a fixed rate on the monotonic clock: each deadline is computed from
+# the previous deadline, not from the end of the previous cycle. Every tick (one per heartbeat) reads the priority
+# registers, and every poll interval a full cycle also reads the low priority ones. Missed ticks are counted and
+# coalesced into a single cycle. A full cycle that exceeds its budget makes the following full cycles skip the
+# low priority registers, for a number of cycles that doubles while the full cycles keep overrunning.
+#
+
+class Scheduler:
+
+    def __init__(self):
+        self.period = HEARTBEAT
+        self.every = 10
+        self.slack = HEARTBEAT / 2.0
+        self.deadline = None
+        self.tick = 0
+        self.nextFull = 0
+        self.backoff = 0
+        self.skip = 0
+        self.cycles = 0
+        self.missed = 0
+        self.overruns = 0
+
+    # Poll interval of the low priority registers, a whole number of ticks
+    def set_interval(self, interval):
+        self.every = int(round(interval / self.period))
+        if self.every < 1:
+            self.every = 1
+
+    def interval(self):
+        return self.every * self.period
+
+    def reset(self):
+        self.deadline = None
+        self.nextFull = self.tick
+
+    # Is a tick due ? Heartbeats up to half a heartbeat early are accepted, late ones coalesce the missed ticks
+    def due(self, now):
+        if self.deadline is None:
+            self.deadline = now
+        if now < self.deadline - self.slack:
+            return False
+        late = max(0, int((now - self.deadline) // self.period))
+        if late > 0:
+            self.missed += late
+            Domoticz.Debug("Scheduler: {} tick(s) missed, {} in total".format(late, self.missed))
+        self.deadline += (late + 1) * self.period
+        self.tick += late + 1
+        self.cycles += 1
+        return True
+
+    # Should this tick read the low priority registers ? Missed full cycles are coalesced as well
+    def full(self):
+        tick = self.tick - 1
+        if tick < self.nextFull:
+            return False
+        while self.nextFull <= tick:
+            self.nextFull += self.every
+        if self.skip > 0:
+            self.skip -= 1
+            return False
+        return True
+
+    def done(self, duration, full):
+        budget = self.period * BUDGET
+        if duration <= budget:
+            if full:
+                self.backoff = 0
+            return
+        self.overruns += 1
+        if full:
+            self.backoff = min(max(1, self.backoff * 2), MAX_BACKOFF)
+            self.skip = self.backoff
+            Domoticz.Log("Poll cycle took {:.2f}s, over its {:.2f}s budget: low priority registers skipped for {} full cycle(s) ({} overruns in {} cycles)".format(duration, budget, self.skip, self.overruns, self.cycles))
+        else:
+            Domoticz.Error("Poll cycle took {:.2f}s with high priority registers only, over its {:.2f}s budget".format(duration, budget))
+
 # Plugin itself
 class BasePlugin:
     def __init__(self):
@@ -106,6 +234,8 @@ class BasePlugin:
         self.current=Average()
         # Power factor for last 5 minutes
         self.power=Average()
+        # Fixed rate poll cycle
+        self.scheduler=Scheduler()
 
         return
 
@@ -132,11 +262,39 @@ class BasePlugin:
             Domoticz.Debugging(0)
 
         self.IPAddress = Parameters["Address"]
-        self.IPPort    = Parameters["Port"]
+        try:
+            self.IPPort = int(Parameters["Port"])
+        except ValueError:
+            Domoticz.Error("Invalid GX Modbus port : "+Parameters["Port"]+", using 502")
+            self.IPPort = 502
         self.MBAddr    = int(Parameters["Mode3"])
+        self.Discovery = Parameters["Mode1"]
+        try:
+            self.scheduler.set_interval(float(Parameters["Mode2"]))
+        except ValueError:
+            Domoticz.Error("Invalid poll interval : "+Parameters["Mode2"]+", using "+str(self.scheduler.interval())+"s")
+
+        # Keep 5 minutes in the sliding windows whatever the poll interval
+        for value in self.__dict__.values():
+            if isinstance(value, Average):
+                value.set_max_samples(int(300 / self.scheduler.interval()))
+        self.power.set_max_samples(int(300 / self.scheduler.period))
+        Domoticz.Heartbeat(HEARTBEAT)
 
         Domoticz.Debug("Query IP " + self.IPAddress + ":" + str(self.IPPort) +" on device : "+str(self.MBAddr))
 
+        # Capability map, loaded from cache or discovered on first heartbeat
+        self.units    = { "mppt": self.MBAddr }
+        self.capsFile = os.path.join(Parameters["HomeFolder"], "capabilities-" + str(Parameters["HardwareID"]) + ".json")
+        self.caps     = None
+        self.clients  = {}
+        self.failingSince = None
+        self.reprobeAt = None
+        if self.Discovery == "Off":
+            self.caps = self.defaultCaps()
+        elif self.Discovery == "Cache":
+            self.caps = self.loadCaps()
+
         # Create the devices if they does not exists
         if 1 not in Devices:
             Domoticz.Device(Name="Voltage",      Unit=1, TypeName="Voltage", Used=0).Create()
@@ -152,45 +310,196 @@ class BasePlugin:
 
 
     def onStop(self):
+        for client in self.clients.values():
+            client.close()
         Domoticz.Debugging(0)
 
     def onHeartbeat(self):
-        Domoticz.Debug(" Interface : IP="+self.IPAddress +", Port="+str(self.IPPort)+" ID="+str(self.MBAddr))
-        try:
-            client = ModbusClient(host=self.IPAddress, port=self.IPPort, unit_id=self.MBAddr, auto_open=True, auto_close=True, timeout=2)
-        except:
-            Domoticz.Error("Error connecting to TCP/Interface on address : "+self.IPaddress+":"+str(self.IPPort))
-            # Set value to 0 -> Error on all devices
-            Devices[1].Update(1, "0")
-            Devices[2].Update(1, "0")
-            Devices[3].Update(1, "0")
-            Devices[4].Update(1, "0")
-
-        total_e = "0"
+        if self.caps is None:
+            if self.Discovery == "Off":
+                self.caps = self.defaultCaps()
+            else:
+                self.caps = self.discover()
+                # Discovery may take a while, start again from a fresh deadline
+                self.scheduler.reset()
+            if self.caps is None:
+                return
+
+        # Registers missing from an incomplete capability map are probed again from time to time
+        if self.reprobeAt is not None and time.monotonic() >= self.reprobeAt:
+            self.reprobe()
+            self.scheduler.reset()
+            if self.caps is None:
+                return
+
+        if not self.scheduler.due(time.monotonic()):
+            return
+
+        full = self.scheduler.full()
+        start = time.monotonic()
+        self.poll(full)
+        self.scheduler.done(time.monotonic() - start, full)
+
+    # One poll cycle, only the priority registers are read when full is False
+    def poll(self, full):
+        mppt = self.caps["mppt"]
+        Domoticz.Debug(" Interface : IP="+self.IPAddress +", Port="+str(self.IPPort)+" ID="+str(mppt["unit"]))
+        values, failed = readregisters(self.getClient(mppt["unit"]), selectregisters(mppt["registers"], full))
+        self.checkFailures(failed, full)
+
         power = "0"
 
         # Voltage
-        value = round (getmodbus16(776, client) / 100.0, 3)
-        self.voltage.update(value)
-        value = self.voltage.get()
-        Devices[1].Update(1, str(value))
+        if 776 in values:
+            value = round (values[776] / 100.0, 3)
+            self.voltage.update(value)
+            value = self.voltage.get()
+            Devices[1].Update(1, str(value))
 
         # Current
-        value = round (getmodbus16(777,client) / 10.0, 3)
-        self.current.update(value)
-        value = self.current.get()
-        Devices[2].Update(1, str(value))
+        if 777 in values:
+            value = round (values[777] / 10.0, 3)
+            self.current.update(value)
+            value = self.current.get()
+            Devices[2].Update(1, str(value))
 
         # Power
-        value = round (getmodbus16(789, client) / 10.0, 3)
-        self.power.update(value)
-        value = self.power.get()
-        Devices[3].Update(1, str(value))
-        power = str(value)
+        if 789 in values:
+            value = round (values[789] / 10.0, 3)
+            self.power.update(value)
+            value = self.power.get()
+            Devices[3].Update(1, str(value))
+            power = str(value)
 
         # Total Energy
-        total_e = str(getmodbus16(790,client)*100)
-        Devices[4].Update(1, sValue=power+";"+total_e)
+        if 790 in values:
+            total_e = str(values[790]*100)
+            Devices[4].Update(1, sValue=power+";"+total_e)
+
+    # Persistent Modbus client for a unit
+    def getClient(self, unit):
+        if unit not in self.clients:
+            self.clients[unit] = ModbusClient(host=self.IPAddress, port=self.IPPort, unit_id=unit, auto_open=True, auto_close=False, timeout=2)
+        return self.clients[unit]
+
+    # Drop the capability map when reads keep failing for a while, whatever the number of cycles.
+    # Only a full cycle without failure shows that every register is back.
+    def checkFailures(self, failed, full):
+        if self.Discovery == "Off":
+            return
+        if failed == 0:
+            if full:
+                self.failingSince = None
+            return
+        now = time.monotonic()
+        if self.failingSince is None:
+            self.failingSince = now
+        elif now - self.failingSince >= MAX_FAILURE_TIME:
+            Domoticz.Error("Registers keep failing since "+str(int(now - self.failingSince))+"s, running discovery again")
+            self.failingSince = None
+            self.caps = None
+
+    # Capability map used when discovery is off: configured address, all registers
+    def defaultCaps(self):
+        caps = {}
+        for role, blocks in ROLES.items():
+            caps[role] = { "unit": self.units[role], "registers": blockregisters(blocks), "missing": [], "unsupported": [] }
+        return caps
+
+    # What the cached map was discovered for, it is discarded when this changes (the port is stored as a number)
+    def capsHeader(self):
+        return json.loads(json.dumps({ "address": self.IPAddress, "port": self.IPPort, "configured": self.units, "blocks": ROLES }))
+
+    def loadCaps(self):
+        try:
+            with open(self.capsFile) as f:
+                caps = json.load(f)
+        except (IOError, ValueError):
+            Domoticz.Log("No usable capability map in "+self.capsFile+", running discovery")
+            return None
+        for key, value in self.capsHeader().items():
+            if caps.get(key) != value:
+                Domoticz.Log("Capability map does not match the hardware setup, running discovery")
+                return None
+        Domoticz.Debug("Capability map loaded from "+self.capsFile+": "+str(caps["roles"]))
+        return caps["roles"]
+
+    def saveCaps(self, roles):
+        caps = self.capsHeader()
+        caps["roles"] = roles
+        try:
+            with open(self.capsFile, "w") as f:
+                json.dump(caps, f, indent=2)
+        except IOError:
+            Domoticz.Error("Cannot write capability map "+self.capsFile)
+
+    # Scan unit IDs for every role, returns None when the GX cannot be reached
+    def discover(self):
+        Domoticz.Log("Discovering units on "+self.IPAddress+":"+str(self.IPPort))
+        probe = ModbusClient(host=self.IPAddress, port=self.IPPort, auto_open=True, auto_close=False, timeout=DISCOVERY_TIMEOUT)
+        if not probe.open():
+            Domoticz.Error("Error connecting to TCP/Interface on address : "+self.IPAddress+":"+str(self.IPPort))
+            return None
+
+        roles = {}
+        for role in ROLES:
+            roles[role] = self.scanRole(probe, role)
+        probe.close()
+
+        self.completeCaps(roles)
+        return roles
+
+    # Scan unit IDs for one role, starting with the configured one
+    def scanRole(self, probe, role):
+        blocks = ROLES[role]
+        configured = self.units[role]
+        for unit in [configured] + [u for u in DISCOVERY_UNITS if u != configured]:
+            probe.unit_id = unit
+            registers, missing, unsupported = probeblocks(probe, blocks)
+            if registers:
+                Domoticz.Log("Found "+role+" on unit "+str(unit)+", registers "+str(registers)+", unsupported "+str(unsupported))
+                return { "unit": unit, "registers": registers, "missing": missing, "unsupported": unsupported }
+        Domoticz.Error("No unit found for "+role+", its devices will not be updated")
+        return { "unit": configured, "registers": [], "missing": blockregisters(blocks), "unsupported": [] }
+
+    # Probe the registers missing from the capability map again, roles without unit are scanned again
+    def reprobe(self):
+        self.reprobeAt = None
+        probe = ModbusClient(host=self.IPAddress, port=self.IPPort, auto_open=True, auto_close=False, timeout=DISCOVERY_TIMEOUT)
+        if not probe.open():
+            Domoticz.Error("Error connecting to TCP/Interface on address : "+self.IPAddress+":"+str(self.IPPort))
+            self.reprobeAt = time.monotonic() + REPROBE_INTERVAL
+            return
+
+        for role, caps in self.caps.items():
+            if not caps["registers"]:
+                self.caps[role] = self.scanRole(probe, role)
+                continue
+            if not caps.get("missing"):
+                continue
+            probe.unit_id = caps["unit"]
+            registers, missing, unsupported = probeblocks(probe, registerruns(caps["missing"]), True)
+            if registers:
+                Domoticz.Log("Registers "+str(registers)+" of "+role+" are now available")
+                caps["registers"] = sorted(caps["registers"] + registers)
+            caps["missing"] = missing
+            caps["unsupported"] = sorted(caps.get("unsupported", []) + unsupported)
+        probe.close()
+
+        self.completeCaps(self.caps)
+
+    # Only a map without missing registers is cached, they are probed again later. Unsupported registers are part of the map.
+    def completeCaps(self, roles):
+        missing = {}
+        for role, caps in roles.items():
+            if caps["missing"]:
+                missing[role] = caps["missing"]
+        if missing:
+            Domoticz.Log("Registers missing from the capability map, probed again in "+str(REPROBE_INTERVAL)+"s: "+str(missing))
+            self.reprobeAt = time.monotonic() + REPROBE_INTERVAL
+        else:
+            self.reprobeAt = None
+            self.saveCaps(roles)
 
 
 global _plugin
@@ -223,25 +532,98 @@ def DumpConfigToLog():
         Domoticz.Debug("Device LastLevel: " + str(Devices[x].LastLevel))
     return
 
-# get Modbug 16 bits values
-def getmodbus16(register, client):
-    value = 0
-    try:
-        data = client.read_holding_registers(register, 1)
-        Domoticz.Debug("Data from register "+str(register)+": "+str(data))
-        #decoder = BinaryPayloadDecoder.fromRegisters(data, byteorder=Endian.Big, wordorder=Endian.Big)
-        decoder = BinaryPayloadDecoder.fromRegisters(data, byteorder=Endian.BIG, wordorder=Endian.BIG)
-        value = decoder.decode_16bit_int()
-    except:
-        Domoticz.Error("Error getting data from "+str(register) + ", try 1")
-        try:
+# All registers of a list of blocks (first register, count)
+def blockregisters(blocks):
+    registers = []
+    for first, count in blocks:
+        registers.extend(range(first, first + count))
+    return registers
+
+# Did the unit itself fail to answer the last request (timeout or gateway exception), rather than refuse the registers ?
+def unitfailed(client):
+    return client.last_error == MB_TIMEOUT_ERR or client.last_except in (EXP_GATEWAY_PATH_UNAVAILABLE, EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+
+# Was the register refused because it does not exist on the unit ?
+def unsupportedregister(client):
+    return client.last_except == EXP_DATA_ADDRESS
+
+# Probe register blocks on a unit with bulk reads. Returns the registers that exist, the missing ones (the unit
+# did not answer, they are worth probing again later) and the unsupported ones (refused with an illegal data
+# address exception). A refused block is probed register by register, unless the unit answered none of the
+# blocks and is not known to exist. Probing stops as soon as the unit does not answer at all.
+def probeblocks(client, blocks, known = False):
+    found = []
+    missing = []
+    unsupported = []
+    refused = []
+    for index, (first, count) in enumerate(blocks):
+        data = client.read_holding_registers(first, count)
+        Domoticz.Debug("Probe of registers "+str(first)+"-"+str(first+count-1)+": "+str(data))
+        if data is not None and len(data) == count:
+            found.extend(range(first, first + count))
+        elif unitfailed(client):
+            Domoticz.Debug("Unit "+str(client.unit_id)+" does not answer")
+            if not found:
+                return [], blockregisters(blocks), []
+            missing.extend(blockregisters(blocks[index:]))
+            break
+        else:
+            refused.append((first, count, unsupportedregister(client)))
+    if not found and not known:
+        return [], blockregisters(blocks), []
+
+    failed = False
+    for first, count, illegal in refused:
+        if count == 1:
+            if illegal:
+                unsupported.append(first)
+            else:
+                missing.append(first)
+            continue
+        for register in range(first, first + count):
+            if failed:
+                missing.append(register)
+                continue
             data = client.read_holding_registers(register, 1)
-            Domoticz.Debug("Data from register "+str(register)+": "+str(data))
-            #decoder = BinaryPayloadDecoder.fromRegisters(data, byteorder=Endian.Big, wordorder=Endian.Big)
-            decoder = BinaryPayloadDecoder.fromRegisters(data, byteorder=Endian.BIG, wordorder=Endian.BIG)
-            value = decoder.decode_16bit_int()
-        except:
-            Domoticz.Error("Error getting data from "+str(register) + ", try 2")
-
-    return value
+            if data is not None and len(data) == 1:
+                found.append(register)
+            elif unsupportedregister(client):
+                unsupported.append(register)
+            else:
+                missing.append(register)
+                failed = unitfailed(client)
+    return sorted(found), sorted(missing), sorted(unsupported)
+
+# Registers to read in a cycle, only the priority ones when the cycle is not full
+def selectregisters(registers, full):
+    if full:
+        return registers
+    return [r for r in registers if r in PRIORITY_REGISTERS]
+
+# Group registers into contiguous runs [first, count], at most 125 registers per Modbus request
+def registerruns(registers):
+    runs = []
+    for register in sorted(registers):
+        if runs and runs[-1][0] + runs[-1][1] == register and runs[-1][1] < 125:
+            runs[-1][1] += 1
+        else:
+            runs.append([register, 1])
+    return runs
+
+# get Modbus 16 bits values of a list of registers, one request per contiguous run and no retry.
+# Returns a dict register -> value and the number of failed requests
+def readregisters(client, registers):
+    values = {}
+    failed = 0
+    for first, count in registerruns(registers):
+        data = client.read_holding_registers(first, count)
+        Domoticz.Debug("Data from registers "+str(first)+"-"+str(first+count-1)+": "+str(data))
+        if data is None or len(data) != count:
+            Domoticz.Error("Error getting data from "+str(first)+"-"+str(first+count-1))
+            failed += 1
+            continue
+        decoder = BinaryPayloadDecoder.fromRegisters(data, byteorder=Endian.BIG, wordorder=Endian.BIG)
+        for register in range(first, first + count):
+            values[register] = decoder.decode_16bit_int()
 
+    return values, failed
@@ -7,10 +7,18 @@ Requirements:
     2. pymodbus AND pymodbusTCP
 """
 """
-<plugin key="VictronEnergy_MultiplusII" name="Victron Energy Multiplus II + Modbus" author="Xavier Beaudouin" version="0.0.2" externallink="https://github.com/xbeaudouin/victron-energy-domoticz/mppt">
+<plugin key="VictronEnergy_MultiplusII" name="Victron Energy Multiplus II + Modbus" author="Xavier Beaudouin" version="0.0.3" externallink="https://github.com/xbeaudouin/victron-energy-domoticz/mppt">
     <params>
         <param field="Address" label="GX IP Address" width="150px" required="true" />
         <param field="Port" label="GX Modbus Port Number" width="100px" required="true" default="502" />
+        <param field="Mode1" label="Unit discovery" width="200px">
+            <options>
+                <option label="Use cached map" value="Cache" default="true" />
+                <option label="Rescan on start" value="Rescan" />
+                <option label="Off (use addresses below)" value="Off" />
+            </options>
+        </param>
+        <param field="Mode2" label="Poll interval (s)" width="50px" required="true" default="10" />
         <param field="Mode3" label="GX Modbus address" width="100px" required="true" default="100" />
         <param field="Mode4" label="Multiplus Modbus address" width="100px" required="true" default="228" />
         <param field="Mode5" label="Battery Modbus address" width="100px" required="true" default="225" />
@@ -25,7 +33,10 @@ Requirements:
 """
 
 import Domoticz
+import json
+import os
 import sys
+import time
 
 sys.path.append('/usr/local/lib/python3.4/dist-packages')
 sys.path.append('/usr/local/lib/python3.5/dist-packages')
@@ -38,9 +49,63 @@ sys.path.append('/usr/local/lib/python3.10/dist-packages')
 import pymodbus
 
 from pyModbusTCP.client import ModbusClient
+from pyModbusTCP.constants import MB_TIMEOUT_ERR, EXP_DATA_ADDRESS, EXP_GATEWAY_PATH_UNAVAILABLE, EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND
 from pymodbus.constants import Endian
 from pymodbus.payload   import BinaryPayloadDecoder
 
+#
+# Unit IDs and registers differ from one GX installation to another.
+# On first heartbeat the plugin scans the plausible unit IDs, starting with the configured ones, and probes the
+# register blocks it uses with bulk reads. The result (the capability map) is cached in the plugin folder, and
+# the heartbeat only queries registers known to exist.
+#
+
+# Register blocks (first register, count) used by the plugin, per role
+ROLES = {
+    "vebus":   [(3, 31), (61, 1)],
+    "battery": [(259, 8)],
+    "system":  [(808, 1), (817, 4), (842, 1), (2700, 1), (2704, 2), (2900, 4)],
+}
+
+# Unit IDs tried during discovery after the configured one: the GX itself, then the device range
+DISCOVERY_UNITS = [100] + list(range(223, 248))
+
+# Timeout (seconds) of the discovery probes, most of them are expected to fail
+DISCOVERY_TIMEOUT = 1
+
+# Time (seconds) reads may keep failing before discovery is run again
+MAX_FAILURE_TIME = 50
+
+# Delay (seconds) before the registers missing from an incomplete capability map are probed again
+REPROBE_INTERVAL = 300
+
+# Domoticz heartbeat (seconds), also the sampling period of the priority registers
+HEARTBEAT = 1
+
+# Share of the heartbeat a cycle may use before low priority registers are dropped
+BUDGET = 0.8
+
+# Maximum number of full cycles the low priority registers are skipped after an overrun
+MAX_BACKOFF = 32
+
+# Registers read on every heartbeat, and still read when the poll cycle is over budget: grid power, used for load control
+PRIORITY_REGISTERS = [820]
+
+# Devices writing ESS settings : device unit -> (role, register, scale, minimum, maximum)
+# register value = device value / scale, and must be within minimum and maximum
+CONTROLS = {
+    40: ("system", 2700, 1,  -32768, 32767),    # ESS grid setpoint (W), int16
+    41: ("system", 2704, 10, 0,      65535),    # ESS max discharge power (W), uint16
+    42: ("system", 2705, 1,  -32768, 32767),    # DVCC max charge current (A), int16, -1 for no limit
+    43: ("vebus",  33,   10, 1,      4),        # Multiplus mode (switch position), selector level / 10
+}
+
+# Write transactions sent to the GX per heartbeat at most
+WRITES_PER_HEARTBEAT = 2
+
+# Delay (seconds) before writing again when the GX did not answer a write
+WRITE_HOLD = 10
+
 #
 # Domoticz shows graphs with intervals of 5 minutes.
 # When collecting information from the inverter more frequently than that, then it makes no sense to only show the last value.
@@ -103,6 +168,135 @@ class Average:
 #    def get(self):
 #        return max(self.samples)
 
+#
+# Domoticz heartbeats are not regular, and a slow Modbus cycle would stretch the sampling period (and the
+# window of the Average class with it).
+#
+# The Scheduler class runs the poll cycles at a fixed rate on the monotonic clock: each deadline is computed from
+# the previous deadline, not from the end of the previous cycle. Every tick (one per heartbeat) reads the priority
+# registers, and every poll interval a full cycle also reads the low priority ones. Missed ticks are counted and
+# coalesced into a single cycle. A full cycle that exceeds its budget makes the following full cycles skip the
+# low priority registers, for a number of cycles that doubles while the full cycles keep overrunning.
+#
+
+class Scheduler:
+
+    def __init__(self):
+        self.period = HEARTBEAT
+        self.every = 10
+        self.slack = HEARTBEAT / 2.0
+        self.deadline = None
+        self.tick = 0
+        self.nextFull = 0
+        self.backoff = 0
+        self.skip = 0
+        self.cycles = 0
+        self.missed = 0
+        self.overruns = 0
+
+    # Poll interval of the low priority registers, a whole number of ticks
+    def set_interval(self, interval):
+        self.every = int(round(interval / self.period))
+        if self.every < 1:
+            self.every = 1
+
+    def interval(self):
+        return self.every * self.period
+
+    def reset(self):
+        self.deadline = None
+        self.nextFull = self.tick
+
+    # Is a tick due ? Heartbeats up to half a heartbeat early are accepted, late ones coalesce the missed ticks
+    def due(self, now):
+        if self.deadline is None:
+            self.deadline = now
+        if now < self.deadline - self.slack:
+            return False
+        late = max(0, int((now - self.deadline) // self.period))
+        if late > 0:
+            self.missed += late
+            Domoticz.Debug("Scheduler: {} tick(s) missed, {} in total".format(late, self.missed))
+        self.deadline += (late + 1) * self.period
+        self.tick += late + 1
+        self.cycles += 1
+        return True
+
+    # Should this tick read the low priority registers ? Missed full cycles are coalesced as well
+    def full(self):
+        tick = self.tick - 1
+        if tick < self.nextFull:
+            return False
+        while self.nextFull <= tick:
+            self.nextFull += self.every
+        if self.skip > 0:
+            self.skip -= 1
+            return False
+        return True
+
+    def done(self, duration, full):
+        budget = self.period * BUDGET
+        if duration <= budget:
+            if full:
+                self.backoff = 0
+            return
+        self.overruns += 1
+        if full:
+            self.backoff = min(max(1, self.backoff * 2), MAX_BACKOFF)
+            self.skip = self.backoff
+            Domoticz.Log("Poll cycle took {:.2f}s, over its {:.2f}s budget: low priority registers skipped for {} full cycle(s) ({} overruns in {} cycles)".format(duration, budget, self.skip, self.overruns, self.cycles))
+        else:
+            Domoticz.Error("Poll cycle took {:.2f}s with high priority registers only, over its {:.2f}s budget".format(duration, budget))
+
+#
+# ESS settings are written from onCommand, which only queues them. Rapid changes of a setting are coalesced to
+# its latest value, and the queue is flushed on heartbeats, a few Modbus transactions at a time, so automations
+# can neither stall the polling nor flood the GX. Contiguous registers of a unit go out together in a single
+# write multiple registers request. Values are queued per role, the unit is only looked up when they are
+# written, as a new discovery may move a role to another unit.
+#
+
+class WriteQueue:
+
+    def __init__(self):
+        self.pending = {}
+
+    def put(self, role, register, value):
+        self.pending[(role, register)] = value & 0xFFFF
+
+    def has(self, role, register):
+        return (role, register) in self.pending
+
+    # Queue again values that could not be written, unless a newer value is waiting
+    def retry(self, role, first, values):
+        for index, value in enumerate(values):
+            if not self.has(role, first + index):
+                self.put(role, first + index, value)
+
+    # Drop the values of registers the capability map no longer has, returns them as (role, register)
+    def prune(self, caps):
+        dropped = []
+        for role, register in sorted(self.pending):
+            if register not in caps[role]["registers"]:
+                del self.pending[(role, register)]
+                dropped.append((role, register))
+        return dropped
+
+    # Take up to limit batches (role, first register, values) off the queue
+    def take(self, limit):
+        batches = []
+        for role, register in sorted(self.pending):
+            value = self.pending[(role, register)]
+            last = batches[-1] if batches else None
+            if last and last[0] == role and last[1] + len(last[2]) == register and len(last[2]) < 123:
+                last[2].append(value)
+            elif len(batches) < limit:
+                batches.append((role, register, [value]))
+            else:
+                continue
+            del self.pending[(role, register)]
+        return batches
+
 # Plugin itself
 class BasePlugin:
     def __init__(self):
@@ -138,6 +332,11 @@ class BasePlugin:
         self.pv=Average()
         # Battery power on last 5 minutes
         self.batteryPower=Average()
+        # Fixed rate poll cycle
+        self.scheduler=Scheduler()
+        # ESS settings waiting to be written
+        self.writes=WriteQueue()
+        self.writeHoldUntil=0
 
         return
 
@@ -164,14 +363,42 @@ class BasePlugin:
             Domoticz.Debugging(0)
 
         self.IPAddress = Parameters["Address"]
-        self.IPPort    = Parameters["Port"]
+        try:
+            self.IPPort = int(Parameters["Port"])
+        except ValueError:
+            Domoticz.Error("Invalid GX Modbus port : "+Parameters["Port"]+", using 502")
+            self.IPPort = 502
         self.MBAddr    = int(Parameters["Mode3"])
         self.MultiAddr = int(Parameters["Mode4"])
         self.BattAddr  = int(Parameters["Mode5"])
+        self.Discovery = Parameters["Mode1"]
+        try:
+            self.scheduler.set_interval(float(Parameters["Mode2"]))
+        except ValueError:
+            Domoticz.Error("Invalid poll interval : "+Parameters["Mode2"]+", using "+str(self.scheduler.interval())+"s")
+
+        # Keep 5 minutes in the sliding windows whatever the poll interval
+        for value in self.__dict__.values():
+            if isinstance(value, Average):
+                value.set_max_samples(int(300 / self.scheduler.interval()))
+        self.gridpower.set_max_samples(int(300 / self.scheduler.period))
+        Domoticz.Heartbeat(HEARTBEAT)
 
 
         Domoticz.Debug("Query IP " + self.IPAddress + ":" + str(self.IPPort) +" on GX device : "+str(self.MBAddr)+" Multi Device : "+str(self.MultiAddr)+" and Battery : "+str(self.BattAddr))
 
+        # Capability map, loaded from cache or discovered on first heartbeat
+        self.units    = { "vebus": self.MultiAddr, "battery": self.BattAddr, "system": self.MBAddr }
+        self.capsFile = os.path.join(Parameters["HomeFolder"], "capabilities-" + str(Parameters["HardwareID"]) + ".json")
+        self.caps     = None
+        self.clients  = {}
+        self.failingSince = None
+        self.reprobeAt = None
+        if self.Discovery == "Off":
+            self.caps = self.defaultCaps()
+        elif self.Discovery == "Cache":
+            self.caps = self.loadCaps()
+
         # Create the devices if they does not exists
         # Multiplus Devices
         if 1 not in Devices:
@@ -227,197 +454,430 @@ class BasePlugin:
         if 35 not in Devices:
             Domoticz.Device(Name="ESS Battery Life SoC Limit", Unit=35, TypeName="Percentage", Used=0).Create()
 
+        # ESS control
+        if 40 not in Devices:
+            Options = { "ValueStep": "10", "ValueMin": "-32000", "ValueMax": "32000", "ValueUnit": "W" }
+            Domoticz.Device(Name="ESS Grid Setpoint",          Unit=40, Type=242, Subtype=1, Used=0, Options=Options).Create()
+        if 41 not in Devices:
+            Options = { "ValueStep": "10", "ValueMin": "0", "ValueMax": "655350", "ValueUnit": "W" }
+            Domoticz.Device(Name="ESS Max Discharge Power",    Unit=41, Type=242, Subtype=1, Used=0, Options=Options).Create()
+        if 42 not in Devices:
+            Options = { "ValueStep": "1", "ValueMin": "-1", "ValueMax": "1000", "ValueUnit": "A" }
+            Domoticz.Device(Name="ESS Max Charge Current",     Unit=42, Type=242, Subtype=1, Used=0, Options=Options).Create()
+        if 43 not in Devices:
+            Options = { "LevelNames": "|Charger Only|Inverter Only|On|Off", "LevelOffHidden": "true", "SelectorStyle": "1" }
+            Domoticz.Device(Name="Multiplus Mode",             Unit=43, TypeName="Selector Switch", Switchtype=18, Used=0, Options=Options).Create()
+
         return
 
 
     def onStop(self):
+        for client in self.clients.values():
+            client.close()
         Domoticz.Debugging(0)
 
     def onHeartbeat(self):
+        if self.caps is None:
+            if self.Discovery == "Off":
+                self.caps = self.defaultCaps()
+            else:
+                self.caps = self.discover()
+                # Discovery may take a while, start again from a fresh deadline
+                self.scheduler.reset()
+            if self.caps is None:
+                return
+
+        # Registers missing from an incomplete capability map are probed again from time to time
+        if self.reprobeAt is not None and time.monotonic() >= self.reprobeAt:
+            self.reprobe()
+            self.scheduler.reset()
+            if self.caps is None:
+                return
+
+        start = time.monotonic()
+        polled = self.scheduler.due(start)
+        if polled:
+            full = self.scheduler.full()
+            self.poll(full)
+
+        # Queued ESS settings go out in what is left of the tick budget, and count in it
+        self.flushWrites(start)
+        if polled:
+            self.scheduler.done(time.monotonic() - start, full)
+
+    def onCommand(self, Unit, Command, Level, Hue):
+        Domoticz.Debug("onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
+        if Unit not in CONTROLS or Command != "Set Level":
+            Domoticz.Error("Unsupported command "+str(Command)+" for unit "+str(Unit))
+            return
+        if self.caps is None:
+            Domoticz.Error("GX units not discovered yet, command for unit "+str(Unit)+" ignored")
+            return
+
+        role, register, scale, minimum, maximum = CONTROLS[Unit]
+        if register not in self.caps[role]["registers"]:
+            Domoticz.Error(Devices[Unit].Name+" is not supported by the GX (register "+str(register)+")")
+            return
+        value = int(round(Level / scale))
+        if value < minimum or value > maximum:
+            Domoticz.Error(Devices[Unit].Name+" value "+str(Level)+" out of range ("+str(minimum * scale)+" to "+str(maximum * scale)+"), not written")
+            return
+        self.writes.put(role, register, value)
+        self.updateControl(Unit, Level)
+
+    # One poll cycle, only the priority registers are read when full is False
+    def poll(self, full):
+        failed = 0
 
         # Multiplus devices
-        Domoticz.Debug("Multiplus Interface : IP="+self.IPAddress +", Port="+str(self.IPPort)+" ID="+str(self.MultiAddr))
-        try:
-            client = ModbusClient(host=self.IPAddress, port=self.IPPort, unit_id=self.MultiAddr, auto_open=True, auto_close=True, timeout=2)
-        except:
-            Domoticz.Error("Error connecting to TCP/Interface on address : "+self.IPaddress+":"+str(self.IPPort))
-            # Set value to 0 -> Error on all devices
-            Devices[1].Update(1, "0")
-            Devices[2].Update(1, "0")
-            Devices[3].Update(1, "0")
-            Devices[4].Update(1, "0")
-            Devices[5].Update(1, "0")
-            Devices[6].Update(1, "0")
-            Devices[7].Update(1, "0")
-            Devices[8].Update(1, "0")
-            Devices[9].Update(1, "0")
-            Devices[10].Update(1, "0")
+        vebus = self.caps["vebus"]
+        Domoticz.Debug("Multiplus Interface : IP="+self.IPAddress +", Port="+str(self.IPPort)+" ID="+str(vebus["unit"]))
+        values, vebusFailed = readregisters(self.getClient(vebus["unit"]), selectregisters(vebus["registers"], full))
+        failed += vebusFailed
 
         # Ac In Voltage
-        self.acInVoltage.update(round(getmodbus16(3, client)/10.0, 3))
-        Devices[1].Update(1, self.acInVoltage.strget())
+        if 3 in values:
+            self.acInVoltage.update(round(values[3]/10.0, 3))
+            Devices[1].Update(1, self.acInVoltage.strget())
 
         # Ac In Current
-        self.acInCurrent.update(round(getmodbus16(6, client)/10.0, 3))
-        Devices[2].Update(1, self.acInCurrent.strget())
+        if 6 in values:
+            self.acInCurrent.update(round(values[6]/10.0, 3))
+            Devices[2].Update(1, self.acInCurrent.strget())
 
         # Ac In Power
-        self.acInPower.update(round(getmodbus16(12, client)/0.1, 3))
-        Devices[3].Update(1, self.acInPower.strget())
+        if 12 in values:
+            self.acInPower.update(round(values[12]/0.1, 3))
+            Devices[3].Update(1, self.acInPower.strget())
 
         # Ac In Frequency
-        self.acInFrequency.update(round(getmodbus16(9, client)/100.0, 3))
-        Devices[4].Update(1, self.acInFrequency.strget())
+        if 9 in values:
+            self.acInFrequency.update(round(values[9]/100.0, 3))
+            Devices[4].Update(1, self.acInFrequency.strget())
 
         # Ac Out Voltage
-        self.acOutVoltage.update(round(getmodbus16(15, client)/10.0, 3))
-        Devices[5].Update(1, self.acOutVoltage.strget())
+        if 15 in values:
+            self.acOutVoltage.update(round(values[15]/10.0, 3))
+            Devices[5].Update(1, self.acOutVoltage.strget())
 
         # Ac Out Current
-        self.acOutCurrent.update(round(getmodbus16(18, client)/10.0, 3))
-        Devices[6].Update(1, self.acOutCurrent.strget())
+        if 18 in values:
+            self.acOutCurrent.update(round(values[18]/10.0, 3))
+            Devices[6].Update(1, self.acOutCurrent.strget())
 
         # Ac Out Power
-        self.acOutPower.update(round(getmodbus16(23, client)/0.1, 3))
-        Devices[7].Update(1, self.acOutPower.strget())
+        if 23 in values:
+            self.acOutPower.update(round(values[23]/0.1, 3))
+            Devices[7].Update(1, self.acOutPower.strget())
 
         # Ac Out Frequency
-        self.acOutFrequency.update(round(getmodbus16(21, client)/100.0, 3))
-        Devices[8].Update(1, self.acOutFrequency.strget())
+        if 21 in values:
+            self.acOutFrequency.update(round(values[21]/100.0, 3))
+            Devices[8].Update(1, self.acOutFrequency.strget())
 
         # Grid lost
-        value = getmodbus16(61, client)
-        if value == 0:
-            Devices[9].Update(nValue=value, sValue="Ok")
-        elif value == 2:
-            Devices[9].Update(nValue=value, sValue="Alert - Grid Lost")
-        else:
-            Devices[9].Update(nValue=3,     sValue="Unknown state ?")
+        if 61 in values:
+            value = values[61]
+            if value == 0:
+                Devices[9].Update(nValue=value, sValue="Ok")
+            elif value == 2:
+                Devices[9].Update(nValue=value, sValue="Alert - Grid Lost")
+            else:
+                Devices[9].Update(nValue=3,     sValue="Unknown state ?")
 
         # VE.Bus state
-        value = getmodbus16(31, client)
-        vebus = 'Unknown?'
-        if value == 0: 
-            vebus = 'Off'
-        elif value == 1:
-            vebus = 'Low Power'
-        elif value == 2:
-            vebus = 'Fault'
-        elif value == 3:
-            vebus = 'Bulk'
-        elif value == 4:
-            vebus = 'Absorption'
-        elif value == 5:
-            vebus = 'Float'
-        elif value == 6:
-            vebus = 'Storage'
-        elif value == 7:
-            vebus = 'Equalize'
-        elif value == 8:
-            vebus = 'Passthru'
-        elif value == 9:
-            vebus = 'Inverting'
-        elif value == 10:
-            vebus = 'Power assist'
-        elif value == 11:
-            vebus = 'Power supply'
-        Devices[10].Update(1, str(value)+": "+vebus)
+        if 31 in values:
+            value = values[31]
+            state = 'Unknown?'
+            if value == 0:
+                state = 'Off'
+            elif value == 1:
+                state = 'Low Power'
+            elif value == 2:
+                state = 'Fault'
+            elif value == 3:
+                state = 'Bulk'
+            elif value == 4:
+                state = 'Absorption'
+            elif value == 5:
+                state = 'Float'
+            elif value == 6:
+                state = 'Storage'
+            elif value == 7:
+                state = 'Equalize'
+            elif value == 8:
+                state = 'Passthru'
+            elif value == 9:
+                state = 'Inverting'
+            elif value == 10:
+                state = 'Power assist'
+            elif value == 11:
+                state = 'Power supply'
+            Devices[10].Update(1, str(value)+": "+state)
+
+        # Multiplus mode
+        self.updateControls("vebus", values)
                 
 
-        # Multiplus devices
-        Domoticz.Debug("Multiplus Interface : IP="+self.IPAddress +", Port="+str(self.IPPort)+" ID="+str(self.BattAddr))
-        try:
-            battery = ModbusClient(host=self.IPAddress, port=self.IPPort, unit_id=self.BattAddr, auto_open=True, auto_close=True, timeout=2)
-        except:
-            Domoticz.Error("Error connecting to TCP/Interface on address : "+self.IPaddress+":"+str(self.IPPort))
-            # Set value to 0 -> Error on all devices
-            Devices[20].Update(1, "0")
-            Devices[21].Update(1, "0")
-            Devices[22].Update(1, "0")
-            Devices[23].Update(1, "0")
+        # Battery devices
+        battery = self.caps["battery"]
+        Domoticz.Debug("Battery Interface : IP="+self.IPAddress +", Port="+str(self.IPPort)+" ID="+str(battery["unit"]))
+        values, batteryFailed = readregisters(self.getClient(battery["unit"]), selectregisters(battery["registers"], full))
+        failed += batteryFailed
 
         # Battery Voltage
-        self.batteryVoltage.update(round(getmodbus16(259, battery)/100.0, 3))
-        Devices[20].Update(1, self.batteryVoltage.strget())
+        if 259 in values:
+            self.batteryVoltage.update(round(values[259]/100.0, 3))
+            Devices[20].Update(1, self.batteryVoltage.strget())
 
         # Battery Current
-        self.batteryCurrent.update(round(getmodbus16(261, battery)/10.0,3))
-        Devices[21].Update(1, self.batteryCurrent.strget())
+        if 261 in values:
+            self.batteryCurrent.update(round(values[261]/10.0,3))
+            Devices[21].Update(1, self.batteryCurrent.strget())
 
         # Battery SOC
-        self.batterySoc.update(round(getmodbus16(266, battery)/10.0,3))
-        Devices[22].Update(1, self.batterySoc.strget())
+        if 266 in values:
+            self.batterySoc.update(round(values[266]/10.0,3))
+            Devices[22].Update(1, self.batterySoc.strget())
 
         # Battery Temperature
-        self.batteryTemp.update(round(getmodbus16(262, battery)/10.0,3))
-        Devices[23].Update(1, self.batteryTemp.strget())
+        if 262 in values:
+            self.batteryTemp.update(round(values[262]/10.0,3))
+            Devices[23].Update(1, self.batteryTemp.strget())
 
         # Victron devices
-        Domoticz.Debug("Multiplus Interface : IP="+self.IPAddress +", Port="+str(self.IPPort)+" ID="+str(self.MBAddr))
-        try:
-            victron = ModbusClient(host=self.IPAddress, port=self.IPPort, unit_id=self.MBAddr, auto_open=True, auto_close=True, timeout=2)
-        except:
-            Domoticz.Error("Error connecting to TCP/Interface on address : "+self.IPaddress+":"+str(self.IPPort))
-            # Set value to 0 -> Error on all devices
-            Devices[30].Update(1, "0")
-            Devices[31].Update(1, "0")
-            Devices[32].Update(1, "0")
-            Devices[33].Update(1, "0")
-            Devices[34].Update(1, "0")
-            Devices[35].Update(1, "0")
+        system = self.caps["system"]
+        Domoticz.Debug("GX Interface : IP="+self.IPAddress +", Port="+str(self.IPPort)+" ID="+str(system["unit"]))
+        values, systemFailed = readregisters(self.getClient(system["unit"]), selectregisters(system["registers"], full))
+        failed += systemFailed
 
         # Grid Power L1
-        self.gridpower.update(getmodbus16(820, victron))
-        Devices[30].Update(1, self.gridpower.strget())
+        if 820 in values:
+            self.gridpower.update(values[820])
+            Devices[30].Update(1, self.gridpower.strget())
 
         # Consumption L1
-        self.conso.update(getmodbus16(817, victron))
-        Devices[31].Update(1, self.conso.strget())
+        if 817 in values:
+            self.conso.update(values[817])
+            Devices[31].Update(1, self.conso.strget())
 
         # PV on Output
-        self.pv.update(getmodbus16(808, victron))
-        Devices[32].Update(1, self.pv.strget())
+        if 808 in values:
+            self.pv.update(values[808])
+            Devices[32].Update(1, self.pv.strget())
 
         # Battery Power
-        self.batteryPower.update(getmodbus16(842, victron))
-        Devices[33].Update(1, self.batteryPower.strget())
+        if 842 in values:
+            self.batteryPower.update(values[842])
+            Devices[33].Update(1, self.batteryPower.strget())
 
         # ESS Battery State
-        value = getmodbus16(2900, victron)
-        batterystate = "Unknown?"
-        onbattery = 0
-        if value == 0:
-            batterystate = "Unused, Battery Life Disabled"
-        elif value == 1:
-            batterystate = "Restarted"
-        elif value == 2:
-            batterystate = "Self-compsumption"
-            onbattery = 1
-        elif value == 3:
-            batterystate = "Self-compsumption, SoC exceeds 85%"
-            onbattery = 1
-        elif value == 4:
-            batterystate = "Self-compsumption, SoC at 100%"
-            onbattery = 1
-        elif value == 5:
-            batterystate = "Discharge disabled"
-        elif value == 6:
-            batterystate = "Force Charge"
-        elif value == 7:
-            batterystate = "Sustain"
-        elif value == 9:
-            batterystate = "Keep batteries charged"
-        elif value == 10:
-            batterystate = "Battery Life disabled"
-        elif value == 11:
-            batterystate = "Battery Life disabled (low SoC)"
-        Devices[34].Update(1, str(value)+": "+batterystate)
+        if 2900 in values:
+            value = values[2900]
+            batterystate = "Unknown?"
+            onbattery = 0
+            if value == 0:
+                batterystate = "Unused, Battery Life Disabled"
+            elif value == 1:
+                batterystate = "Restarted"
+            elif value == 2:
+                batterystate = "Self-compsumption"
+                onbattery = 1
+            elif value == 3:
+                batterystate = "Self-compsumption, SoC exceeds 85%"
+                onbattery = 1
+            elif value == 4:
+                batterystate = "Self-compsumption, SoC at 100%"
+                onbattery = 1
+            elif value == 5:
+                batterystate = "Discharge disabled"
+            elif value == 6:
+                batterystate = "Force Charge"
+            elif value == 7:
+                batterystate = "Sustain"
+            elif value == 9:
+                batterystate = "Keep batteries charged"
+            elif value == 10:
+                batterystate = "Battery Life disabled"
+            elif value == 11:
+                batterystate = "Battery Life disabled (low SoC)"
+            Devices[34].Update(1, str(value)+": "+batterystate)
         # TODO: add a device to say on battery yes/no
         # use the "onbattery" variable
 
         # ESS Battery Life SoC Limit
-        value = (getmodbus16(2903, victron) / 10.0)
-        Devices[35].Update(1, str(value))
+        if 2903 in values:
+            value = (values[2903] / 10.0)
+            Devices[35].Update(1, str(value))
+
+        # ESS settings
+        self.updateControls("system", values)
+
+        self.checkFailures(failed, full)
+
+    # Reflect the settings read from the GX on the control devices, unless a new value is waiting to be written
+    def updateControls(self, role, values):
+        for device, (controlRole, register, scale, minimum, maximum) in CONTROLS.items():
+            if controlRole == role and register in values and not self.writes.has(role, register):
+                value = values[register]
+                # Registers are decoded as int16, unsigned ones are converted back
+                if minimum >= 0:
+                    value = value & 0xFFFF
+                self.updateControl(device, value * scale)
+
+    def updateControl(self, device, value):
+        # Selector switch for the mode, setpoints for the others, all of them whole numbers
+        nValue = 1 if device == 43 else 0
+        sValue = str(int(round(value)))
+        if Devices[device].sValue != sValue:
+            Devices[device].Update(nValue=nValue, sValue=sValue)
+
+    # Write queued settings, one batch at a time while the tick started at start is within its budget
+    def flushWrites(self, start):
+        # The queue is held while the units are discovered again, and for a while after the GX did not answer
+        if self.caps is None or time.monotonic() < self.writeHoldUntil:
+            return
+        for role, register in self.writes.prune(self.caps):
+            Domoticz.Error("Register "+str(register)+" of "+role+" is no longer supported by the GX, value not written")
+        for i in range(WRITES_PER_HEARTBEAT):
+            if time.monotonic() - start >= self.scheduler.period * BUDGET:
+                return
+            batches = self.writes.take(1)
+            if not batches:
+                return
+            role, first, values = batches[0]
+            client = self.getClient(self.caps[role]["unit"])
+            if not writeregisters(client, first, values) and unitfailed(client):
+                Domoticz.Error("GX does not answer, writes held for "+str(WRITE_HOLD)+"s")
+                self.writes.retry(role, first, values)
+                self.writeHoldUntil = time.monotonic() + WRITE_HOLD
+                return
+
+    # Persistent Modbus client for a unit
+    def getClient(self, unit):
+        if unit not in self.clients:
+            self.clients[unit] = ModbusClient(host=self.IPAddress, port=self.IPPort, unit_id=unit, auto_open=True, auto_close=False, timeout=2)
+        return self.clients[unit]
+
+    # Drop the capability map when reads keep failing for a while, whatever the number of cycles.
+    # Only a full cycle without failure shows that every register is back.
+    def checkFailures(self, failed, full):
+        if self.Discovery == "Off":
+            return
+        if failed == 0:
+            if full:
+                self.failingSince = None
+            return
+        now = time.monotonic()
+        if self.failingSince is None:
+            self.failingSince = now
+        elif now - self.failingSince >= MAX_FAILURE_TIME:
+            Domoticz.Error("Registers keep failing since "+str(int(now - self.failingSince))+"s, running discovery again")
+            self.failingSince = None
+            self.caps = None
+
+    # Capability map used when discovery is off: configured address, all registers
+    def defaultCaps(self):
+        caps = {}
+        for role, blocks in ROLES.items():
+            caps[role] = { "unit": self.units[role], "registers": blockregisters(blocks), "missing": [], "unsupported": [] }
+        return caps
+
+    # What the cached map was discovered for, it is discarded when this changes (the port is stored as a number)
+    def capsHeader(self):
+        return json.loads(json.dumps({ "address": self.IPAddress, "port": self.IPPort, "configured": self.units, "blocks": ROLES }))
+
+    def loadCaps(self):
+        try:
+            with open(self.capsFile) as f:
+                caps = json.load(f)
+        except (IOError, ValueError):
+            Domoticz.Log("No usable capability map in "+self.capsFile+", running discovery")
+            return None
+        for key, value in self.capsHeader().items():
+            if caps.get(key) != value:
+                Domoticz.Log("Capability map does not match the hardware setup, running discovery")
+                return None
+        Domoticz.Debug("Capability map loaded from "+self.capsFile+": "+str(caps["roles"]))
+        return caps["roles"]
+
+    def saveCaps(self, roles):
+        caps = self.capsHeader()
+        caps["roles"] = roles
+        try:
+            with open(self.capsFile, "w") as f:
+                json.dump(caps, f, indent=2)
+        except IOError:
+            Domoticz.Error("Cannot write capability map "+self.capsFile)
+
+    # Scan unit IDs for every role, returns None when the GX cannot be reached
+    def discover(self):
+        Domoticz.Log("Discovering units on "+self.IPAddress+":"+str(self.IPPort))
+        probe = ModbusClient(host=self.IPAddress, port=self.IPPort, auto_open=True, auto_close=False, timeout=DISCOVERY_TIMEOUT)
+        if not probe.open():
+            Domoticz.Error("Error connecting to TCP/Interface on address : "+self.IPAddress+":"+str(self.IPPort))
+            return None
+
+        roles = {}
+        for role in ROLES:
+            roles[role] = self.scanRole(probe, role)
+        probe.close()
+
+        self.completeCaps(roles)
+        return roles
+
+    # Scan unit IDs for one role, starting with the configured one
+    def scanRole(self, probe, role):
+        blocks = ROLES[role]
+        configured = self.units[role]
+        for unit in [configured] + [u for u in DISCOVERY_UNITS if u != configured]:
+            probe.unit_id = unit
+            registers, missing, unsupported = probeblocks(probe, blocks)
+            if registers:
+                Domoticz.Log("Found "+role+" on unit "+str(unit)+", registers "+str(registers)+", unsupported "+str(unsupported))
+                return { "unit": unit, "registers": registers, "missing": missing, "unsupported": unsupported }
+        Domoticz.Error("No unit found for "+role+", its devices will not be updated")
+        return { "unit": configured, "registers": [], "missing": blockregisters(blocks), "unsupported": [] }
+
+    # Probe the registers missing from the capability map again, roles without unit are scanned again
+    def reprobe(self):
+        self.reprobeAt = None
+        probe = ModbusClient(host=self.IPAddress, port=self.IPPort, auto_open=True, auto_close=False, timeout=DISCOVERY_TIMEOUT)
+        if not probe.open():
+            Domoticz.Error("Error connecting to TCP/Interface on address : "+self.IPAddress+":"+str(self.IPPort))
+            self.reprobeAt = time.monotonic() + REPROBE_INTERVAL
+            return
+
+        for role, caps in self.caps.items():
+            if not caps["registers"]:
+                self.caps[role] = self.scanRole(probe, role)
+                continue
+            if not caps.get("missing"):
+                continue
+            probe.unit_id = caps["unit"]
+            registers, missing, unsupported = probeblocks(probe, registerruns(caps["missing"]), True)
+            if registers:
+                Domoticz.Log("Registers "+str(registers)+" of "+role+" are now available")
+                caps["registers"] = sorted(caps["registers"] + registers)
+            caps["missing"] = missing
+            caps["unsupported"] = sorted(caps.get("unsupported", []) + unsupported)
+        probe.close()
+
+        self.completeCaps(self.caps)
+
+    # Only a map without missing registers is cached, they are probed again later. Unsupported registers are part of the map.
+    def completeCaps(self, roles):
+        missing = {}
+        for role, caps in roles.items():
+            if caps["missing"]:
+                missing[role] = caps["missing"]
+        if missing:
+            Domoticz.Log("Registers missing from the capability map, probed again in "+str(REPROBE_INTERVAL)+"s: "+str(missing))
+            self.reprobeAt = time.monotonic() + REPROBE_INTERVAL
+        else:
+            self.reprobeAt = None
+            self.saveCaps(roles)
+
 
 global _plugin
 _plugin = BasePlugin()
@@ -434,6 +894,10 @@ def onHeartbeat():
     global _plugin
     _plugin.onHeartbeat()
 
+def onCommand(Unit, Command, Level, Hue):
+    global _plugin
+    _plugin.onCommand(Unit, Command, Level, Hue)
+
     # Generic helper functions
 def DumpConfigToLog():
     for x in Parameters:
@@ -450,25 +914,107 @@ def DumpConfigToLog():
     return
 
 
-# get Modbus 16 bits values
-def getmodbus16(register, client):
-    value = 0
-    try:
-        data = client.read_holding_registers(register, 1)
-        Domoticz.Debug("Data from register "+str(register)+": "+str(data))
-        #decoder = BinaryPayloadDecoder.fromRegisters(data, byteorder=Endian.Big, wordorder=Endian.Big)
-        decoder = BinaryPayloadDecoder.fromRegisters(data, byteorder=Endian.BIG, wordorder=Endian.BIG)
-        value = decoder.decode_16bit_int()
-    except:
-        Domoticz.Error("Error getting data from "+str(register) + ", try 1")
-        try:
+# All registers of a list of blocks (first register, count)
+def blockregisters(blocks):
+    registers = []
+    for first, count in blocks:
+        registers.extend(range(first, first + count))
+    return registers
+
+# Did the unit itself fail to answer the last request (timeout or gateway exception), rather than refuse the registers ?
+def unitfailed(client):
+    return client.last_error == MB_TIMEOUT_ERR or client.last_except in (EXP_GATEWAY_PATH_UNAVAILABLE, EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+
+# Was the register refused because it does not exist on the unit ?
+def unsupportedregister(client):
+    return client.last_except == EXP_DATA_ADDRESS
+
+# Probe register blocks on a unit with bulk reads. Returns the registers that exist, the missing ones (the unit
+# did not answer, they are worth probing again later) and the unsupported ones (refused with an illegal data
+# address exception). A refused block is probed register by register, unless the unit answered none of the
+# blocks and is not known to exist. Probing stops as soon as the unit does not answer at all.
+def probeblocks(client, blocks, known = False):
+    found = []
+    missing = []
+    unsupported = []
+    refused = []
+    for index, (first, count) in enumerate(blocks):
+        data = client.read_holding_registers(first, count)
+        Domoticz.Debug("Probe of registers "+str(first)+"-"+str(first+count-1)+": "+str(data))
+        if data is not None and len(data) == count:
+            found.extend(range(first, first + count))
+        elif unitfailed(client):
+            Domoticz.Debug("Unit "+str(client.unit_id)+" does not answer")
+            if not found:
+                return [], blockregisters(blocks), []
+            missing.extend(blockregisters(blocks[index:]))
+            break
+        else:
+            refused.append((first, count, unsupportedregister(client)))
+    if not found and not known:
+        return [], blockregisters(blocks), []
+
+    failed = False
+    for first, count, illegal in refused:
+        if count == 1:
+            if illegal:
+                unsupported.append(first)
+            else:
+                missing.append(first)
+            continue
+        for register in range(first, first + count):
+            if failed:
+                missing.append(register)
+                continue
             data = client.read_holding_registers(register, 1)
-            Domoticz.Debug("Data from register "+str(register)+": "+str(data))
-            #decoder = BinaryPayloadDecoder.fromRegisters(data, byteorder=Endian.Big, wordorder=Endian.Big)
-            decoder = BinaryPayloadDecoder.fromRegisters(data, byteorder=Endian.BIG, wordorder=Endian.BIG)
-            value = decoder.decode_16bit_int()
-        except:
-            Domoticz.Error("Error getting data from "+str(register) + ", try 2")
+            if data is not None and len(data) == 1:
+                found.append(register)
+            elif unsupportedregister(client):
+                unsupported.append(register)
+            else:
+                missing.append(register)
+                failed = unitfailed(client)
+    return sorted(found), sorted(missing), sorted(unsupported)
+
+# Registers to read in a cycle, only the priority ones when the cycle is not full
+def selectregisters(registers, full):
+    if full:
+        return registers
+    return [r for r in registers if r in PRIORITY_REGISTERS]
+
+# Group registers into contiguous runs [first, count], at most 125 registers per Modbus request
+def registerruns(registers):
+    runs = []
+    for register in sorted(registers):
+        if runs and runs[-1][0] + runs[-1][1] == register and runs[-1][1] < 125:
+            runs[-1][1] += 1
+        else:
+            runs.append([register, 1])
+    return runs
+
+# get Modbus 16 bits values of a list of registers, one request per contiguous run and no retry.
+# Returns a dict register -> value and the number of failed requests
+def readregisters(client, registers):
+    values = {}
+    failed = 0
+    for first, count in registerruns(registers):
+        data = client.read_holding_registers(first, count)
+        Domoticz.Debug("Data from registers "+str(first)+"-"+str(first+count-1)+": "+str(data))
+        if data is None or len(data) != count:
+            Domoticz.Error("Error getting data from "+str(first)+"-"+str(first+count-1))
+            failed += 1
+            continue
+        decoder = BinaryPayloadDecoder.fromRegisters(data, byteorder=Endian.BIG, wordorder=Endian.BIG)
+        for register in range(first, first + count):
+            values[register] = decoder.decode_16bit_int()
+
+    return values, failed
 
-    return value
+# set Modbus 16 bits values of contiguous registers in a single request, no retry : the GX state is read back
+def writeregisters(client, first, values):
+    Domoticz.Debug("Writing registers "+str(first)+"-"+str(first+len(values)-1)+": "+str(values))
+    if not client.write_multiple_registers(first, values):
+        Domoticz.Error("Error writing data to "+str(first)+"-"+str(first+len(values)-1))
+        return False
 
+    return True